@@ -1,3 +1,7 @@
+-- Write-ahead logging is persistent for the database file, so readers
+-- (including the analytics MCP server) never block writers
+PRAGMA journal_mode = WAL;
+
 -- Users table
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -100,13 +104,48 @@ CREATE TABLE IF NOT EXISTS email_outreach (
     FOREIGN KEY (template_id) REFERENCES email_templates(id)
 );
 
+-- Daily conversation counters (maintained by triggers below)
+CREATE TABLE IF NOT EXISTS conversation_daily_stats (
+    day DATE PRIMARY KEY,
+    total INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0
+);
+
 -- Create indexes (AFTER tables are created)
 CREATE INDEX IF NOT EXISTS idx_users_platform_user_id ON users(platform, platform_user_id);
 CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations(user_id);
+CREATE INDEX IF NOT EXISTS idx_conversations_started_at_status ON conversations(started_at, status, current_flow);
 CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages(conversation_id);
 CREATE INDEX IF NOT EXISTS idx_analytics_event_type ON analytics(event_type);
 CREATE INDEX IF NOT EXISTS idx_analytics_created_at ON analytics(created_at);
 CREATE INDEX IF NOT EXISTS idx_survey_responses_user ON survey_responses(user_id);
 CREATE INDEX IF NOT EXISTS idx_survey_responses_survey ON survey_responses(survey_name);
 CREATE INDEX IF NOT EXISTS idx_email_outreach_user ON email_outreach(user_id);
-CREATE INDEX IF NOT EXISTS idx_email_outreach_status ON email_outreach(status);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_email_outreach_status ON email_outreach(status);
+
+-- Backfill daily counters for conversations created before the triggers existed
+INSERT OR IGNORE INTO conversation_daily_stats (day, total, completed)
+SELECT date(started_at), COUNT(*), SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END)
+FROM conversations
+WHERE started_at IS NOT NULL
+GROUP BY date(started_at);
+
+-- Create triggers
+CREATE TRIGGER IF NOT EXISTS trg_conversations_daily_stats_insert
+AFTER INSERT ON conversations
+BEGIN
+    INSERT INTO conversation_daily_stats (day, total, completed)
+    VALUES (date(NEW.started_at), 1, CASE WHEN NEW.status = 'completed' THEN 1 ELSE 0 END)
+    ON CONFLICT(day) DO UPDATE SET
+        total = total + 1,
+        completed = completed + excluded.completed;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_conversations_daily_stats_status
+AFTER UPDATE OF status ON conversations
+WHEN (OLD.status IS 'completed') != (NEW.status IS 'completed')
+BEGIN
+    UPDATE conversation_daily_stats
+    SET completed = completed + CASE WHEN NEW.status IS 'completed' THEN 1 ELSE -1 END
+    WHERE day = date(NEW.started_at);
+END;
\ No newline at end of file
@@ -5,105 +5,275 @@ Track events, generate reports, calculate metrics
 """
 
 import asyncio
-import json
-from datetime import datetime, timedelta
+import orjson
 from mcp.server import Server, NotificationOptions
 from mcp.server.models import InitializationOptions
 import mcp.server.stdio
 import mcp.types as types
 import sqlite3
+import queue
+import logging
+import time
 import os
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+READ_POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256
+
+# Bound parameter limit per statement. SQLite 3.32+ defaults to 32766, but
+# older builds still supported here default to 999.
+SQLITE_MAX_VARIABLES = 999
+
+# Queued events are written once this many are pending or the interval elapses.
+# Each batch is a single multi-row INSERT binding two parameters per event.
+FLUSH_MAX_ROWS = min(500, SQLITE_MAX_VARIABLES // 2)
+FLUSH_INTERVAL = 0.05
+
+# A batch that finds the database locked by another writer (e.g. the Node
+# app) past busy_timeout is retried whole, this many times in total
+WRITE_MAX_ATTEMPTS = 5
+WRITE_RETRY_DELAY = 1.0
+
+# Errors caused by a particular event rather than by the database's state
+ROW_ERRORS = (sqlite3.IntegrityError, sqlite3.ProgrammingError, sqlite3.InterfaceError)
+
+# Seconds a get_metrics result is served from memory, and how many are kept
+METRICS_CACHE_TTL = 300
+METRICS_CACHE_SIZE = 32
+
+# Per-connection settings, applied to every pooled connection
+PRAGMAS = (
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA busy_timeout=5000',
+)
 
 class Analytics:
-    def __init__(self, db_path):
-        self.db_path = db_path
+    _INSERT_EVENTS_SQL = 'INSERT INTO analytics (event_type, metadata) VALUES '
+    _EVENT_PLACEHOLDERS = '(?, ?)'
     
-    def track_event(self, event_type, metadata):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def __init__(self, db_path, read_pool_size=READ_POOL_SIZE):
+        self.db_path = db_path
         
-        cursor.execute(
-            '''INSERT INTO analytics (event_type, metadata)
-               VALUES (?, ?)''',
-            (event_type, json.dumps(metadata))
+        # One long-lived read-write connection, writes serialized by the lock
+        self._rw_conn = sqlite3.connect(
+            db_path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=STATEMENT_CACHE_SIZE
         )
+        # busy_timeout is applied first so switching to WAL waits out other writers
+        self._apply_pragmas(self._rw_conn)
+        journal_mode = self._rw_conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        if journal_mode != 'wal':
+            logger.warning('Could not enable WAL on %s, journal_mode is %s', db_path, journal_mode)
+        self._rw_conn.execute('PRAGMA synchronous=NORMAL')
+        self._write_lock = asyncio.Lock()
         
-        conn.commit()
-        conn.close()
-    
-    def get_metrics(self, days=7):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # Small pool of read-only connections for metrics queries
+        self._read_pool = queue.Queue()
+        for _ in range(read_pool_size):
+            conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False)
+            self._apply_pragmas(conn)
+            self._read_pool.put(conn)
         
-        since_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        # Events waiting to be written by the flusher
+        self._queue = asyncio.Queue()
         
-        # Total conversations
-        cursor.execute(
-            '''SELECT COUNT(*) FROM conversations 
-               WHERE created_at >= ?''',
-            (since_date,)
-        )
-        total_conversations = cursor.fetchone()[0]
+        # days -> (monotonic timestamp, metrics), least recently used first
+        self._metrics_cache = OrderedDict()
+    
+    @staticmethod
+    def _apply_pragmas(conn):
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+    
+    @contextmanager
+    def _acquire(self):
+        conn = self._read_pool.get()
+        try:
+            yield conn
+        finally:
+            self._read_pool.put(conn)
+    
+    @staticmethod
+    def _copy_metrics(metrics):
+        # Callers get their own copy so they cannot mutate the cached entry
+        return {**metrics, 'top_flows': [dict(flow) for flow in metrics['top_flows']]}
+    
+    def close(self):
+        while not self._read_pool.empty():
+            self._read_pool.get_nowait().close()
+        self._rw_conn.close()
+    
+    async def track_event(self, event_type, metadata):
+        # Writes happen later in the flusher, so reject what the table would refuse now
+        if event_type is None:
+            raise ValueError('event_type is required')
+        try:
+            encoded = orjson.dumps(metadata).decode()
+        except orjson.JSONEncodeError as e:
+            # Unlike json.dumps, orjson rejects e.g. integers wider than 64 bits
+            raise ValueError(f'metadata is not serializable: {e}') from e
+        await self._queue.put((event_type, encoded))
+    
+    async def run_flusher(self):
+        """Write queued events in batches until stop() is called"""
+        while True:
+            batch = [await self._queue.get()]
+            # Give a burst of events a moment to accumulate
+            if self._queue.qsize() < FLUSH_MAX_ROWS - 1:
+                await asyncio.sleep(FLUSH_INTERVAL)
+            while len(batch) < FLUSH_MAX_ROWS and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            
+            rows = [item for item in batch if item is not None]
+            if rows:
+                try:
+                    await self._write_batch(rows)
+                except Exception:
+                    # Keep flushing later events even if this batch is lost
+                    logger.exception('Failed to write %d analytics events', len(rows))
+            if len(rows) < len(batch):
+                return
+    
+    async def stop(self):
+        """Ask the flusher to write everything queued so far and exit"""
+        await self._queue.put(None)
+    
+    async def _write_batch(self, rows):
+        rows = list(rows)
+        one_by_one = False
+        attempt = 1
+        async with self._write_lock:
+            while True:
+                try:
+                    if one_by_one:
+                        await asyncio.to_thread(self._insert_events_individually, rows)
+                    else:
+                        await asyncio.to_thread(self._insert_events, rows)
+                    return
+                except ROW_ERRORS:
+                    # One bad event must not take the rest of the batch with it
+                    logger.warning('Batch insert of %d analytics events failed, retrying one by one', len(rows))
+                    one_by_one = True
+                except sqlite3.OperationalError:
+                    if attempt >= WRITE_MAX_ATTEMPTS:
+                        raise
+                    logger.warning('Analytics database busy, retrying %d events (attempt %d)', len(rows), attempt)
+                    attempt += 1
+                    await asyncio.sleep(WRITE_RETRY_DELAY)
+    
+    def _insert_events(self, rows):
+        sql = self._INSERT_EVENTS_SQL + ', '.join([self._EVENT_PLACEHOLDERS] * len(rows))
+        params = [value for row in rows for value in row]
         
-        # Completed flows
-        cursor.execute(
-            '''SELECT COUNT(*) FROM conversations 
-               WHERE status = 'completed' AND created_at >= ?''',
-            (since_date,)
-        )
-        completed_flows = cursor.fetchone()[0]
+        self._rw_conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._rw_conn.execute(sql, params)
+            self._rw_conn.execute('COMMIT')
+        except Exception:
+            if self._rw_conn.in_transaction:
+                self._rw_conn.execute('ROLLBACK')
+            raise
+    
+    def _insert_events_individually(self, rows):
+        # Consumes rows from the front, so a retry after a busy error resumes here
+        while rows:
+            try:
+                self._insert_events(rows[:1])
+            except ROW_ERRORS:
+                logger.exception('Dropping analytics event %r', rows[0][0])
+            del rows[0]
+    
+    def _fetch_totals(self, days):
+        # Total conversations and completed flows from the daily counters
+        with self._acquire() as conn:
+            return conn.execute(
+                '''SELECT COALESCE(SUM(total), 0), COALESCE(SUM(completed), 0)
+                   FROM conversation_daily_stats 
+                   WHERE day >= date('now', '-' || ? || ' days')''',
+                (days,)
+            ).fetchone()
+    
+    def _fetch_top_flows(self, days):
+        # Most triggered flows, already encoded as a JSON array by SQLite
+        with self._acquire() as conn:
+            return conn.execute(
+                '''SELECT json_group_array(json_object('flow', current_flow, 'count', count))
+                   FROM (
+                       SELECT current_flow, COUNT(*) as count 
+                       FROM conversations 
+                       WHERE started_at >= date('now', '-' || ? || ' days')
+                       GROUP BY current_flow
+                       ORDER BY count DESC
+                       LIMIT 5
+                   )''',
+                (days,)
+            ).fetchone()[0]
+    
+    async def get_metrics(self, days=7):
+        cached = self._metrics_cache.get(days)
+        if cached and time.monotonic() - cached[0] < METRICS_CACHE_TTL:
+            self._metrics_cache.move_to_end(days)
+            return self._copy_metrics(cached[1])
         
-        # Most triggered flows
-        cursor.execute(
-            '''SELECT current_flow, COUNT(*) as count 
-               FROM conversations 
-               WHERE created_at >= ?
-               GROUP BY current_flow
-               ORDER BY count DESC
-               LIMIT 5''',
-            (since_date,)
+        # Both queries run on their own pooled read connection
+        (total_conversations, completed_flows), top_flows = await asyncio.gather(
+            asyncio.to_thread(self._fetch_totals, days),
+            asyncio.to_thread(self._fetch_top_flows, days)
         )
-        top_flows = cursor.fetchall()
-        
-        conn.close()
         
-        return {
+        metrics = {
             'period_days': days,
             'total_conversations': total_conversations,
             'completed_flows': completed_flows,
             'completion_rate': completed_flows / total_conversations if total_conversations > 0 else 0,
-            'top_flows': [{'flow': f[0], 'count': f[1]} for f in top_flows]
+            'top_flows': orjson.loads(top_flows)
         }
+        self._metrics_cache[days] = (time.monotonic(), metrics)
+        self._metrics_cache.move_to_end(days)
+        if len(self._metrics_cache) > METRICS_CACHE_SIZE:
+            self._metrics_cache.popitem(last=False)
+        
+        return self._copy_metrics(metrics)
 
 server = Server("analytics")
 analytics = Analytics(os.path.join(os.path.dirname(__file__), '../../data/chatbot.db'))
 
+# Tool definitions never change, so build them once at import
+TOOLS = [
+    types.Tool(
+        name="track_event",
+        description="Track a custom event",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "event_type": {"type": "string"},
+                "metadata": {"type": "object"}
+            },
+            "required": ["event_type"]
+        }
+    ),
+    types.Tool(
+        name="get_metrics",
+        description="Get conversation metrics",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "days": {"type": "integer", "default": 7}
+            }
+        }
+    )
+]
+
 @server.list_tools()
 async def handle_list_tools() -> list[types.Tool]:
-    return [
-        types.Tool(
-            name="track_event",
-            description="Track a custom event",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "event_type": {"type": "string"},
-                    "metadata": {"type": "object"}
-                },
-                "required": ["event_type"]
-            }
-        ),
-        types.Tool(
-            name="get_metrics",
-            description="Get conversation metrics",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "days": {"type": "integer", "default": 7}
-                }
-            }
-        )
-    ]
+    return TOOLS
 
 @server.call_tool()
 async def handle_call_tool(
@@ -111,38 +281,48 @@ async def handle_call_tool(
 ) -> list[types.TextContent]:
     
     if name == "track_event":
-        analytics.track_event(
+        await analytics.track_event(
             arguments["event_type"],
             arguments.get("metadata", {})
         )
         return [types.TextContent(
             type="text",
-            text=json.dumps({"status": "tracked"})
+            text=orjson.dumps({"status": "tracked"}).decode()
         )]
     
     elif name == "get_metrics":
-        metrics = analytics.get_metrics(arguments.get("days", 7))
+        metrics = await analytics.get_metrics(arguments.get("days", 7))
         return [types.TextContent(
             type="text",
-            text=json.dumps(metrics, indent=2)
+            text=orjson.dumps(metrics, option=orjson.OPT_INDENT_2).decode()
         )]
     
     raise ValueError(f"Unknown tool: {name}")
 
 async def main():
-    async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
-        await server.run(
-            read_stream,
-            write_stream,
-            InitializationOptions(
-                server_name="analytics",
-                server_version="1.0.0",
-                capabilities=server.get_capabilities(
-                    notification_options=NotificationOptions(),
-                    experimental_capabilities={}
+    flusher = asyncio.create_task(analytics.run_flusher())
+    try:
+        async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
+            await server.run(
+                read_stream,
+                write_stream,
+                InitializationOptions(
+                    server_name="analytics",
+                    server_version="1.0.0",
+                    capabilities=server.get_capabilities(
+                        notification_options=NotificationOptions(),
+                        experimental_capabilities={}
+                    )
                 )
             )
-        )
+    finally:
+        # The flusher is stopped rather than cancelled so a batch
+        # write running in a worker thread is never abandoned
+        try:
+            await analytics.stop()
+            await flusher
+        finally:
+            analytics.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
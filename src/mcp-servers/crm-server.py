@@ -5,26 +5,116 @@ Handles contacts, deals, notes, and tasks
 """
 
 import asyncio
-import json
+import orjson
 from typing import Any
 from mcp.server import Server, NotificationOptions
 from mcp.server.models import InitializationOptions
 import mcp.server.stdio
 import mcp.types as types
 import sqlite3
+import queue
+import logging
+import time
 import os
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+READ_POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256
+
+# Tags are stored as binary JSONB where SQLite supports it (3.45+)
+TAGS_ENCODER = 'jsonb' if sqlite3.sqlite_version_info >= (3, 45, 0) else 'json'
+
+# Seconds a get_contact result is served from memory, and how many are kept
+CONTACT_CACHE_TTL = 30
+CONTACT_CACHE_SIZE = 1024
+
+# Per-connection settings, applied to every pooled connection
+PRAGMAS = (
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA busy_timeout=5000',
+)
 
 # Simple in-memory CRM for demo (replace with real CRM API)
 class SimpleCRM:
-    def __init__(self, db_path):
+    _INSERT_CONTACT_SQL = f'''INSERT INTO contacts (name, email, phone, company, tags)
+                              VALUES (?, ?, ?, ?, {TAGS_ENCODER}(?))'''
+    _INSERT_DEAL_SQL = '''INSERT INTO deals (contact_id, title, value, stage)
+                          VALUES (?, ?, ?, ?)'''
+    
+    def __init__(self, db_path, read_pool_size=READ_POOL_SIZE):
         self.db_path = db_path
-        self.init_db()
+        
+        # One long-lived read-write connection, writes serialized by the lock
+        self._rw_conn = sqlite3.connect(
+            db_path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        # busy_timeout is applied first so switching to WAL waits out other writers
+        self._apply_pragmas(self._rw_conn)
+        journal_mode = self._rw_conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        if journal_mode != 'wal':
+            logger.warning('Could not enable WAL on %s, journal_mode is %s', db_path, journal_mode)
+        self._rw_conn.execute('PRAGMA synchronous=NORMAL')
+        self._write_lock = asyncio.Lock()
+        
+        # Small pool of read-only connections for contact lookups
+        self._read_pool = queue.Queue()
+        for _ in range(read_pool_size):
+            conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._apply_pragmas(conn)
+            self._read_pool.put(conn)
+        
+        # contact_id -> (monotonic timestamp, contact), least recently used first
+        self._contact_cache = OrderedDict()
+        # Bumped on every invalidation so in-flight lookups know a write landed
+        self._contact_writes = 0
+    
+    @staticmethod
+    def _apply_pragmas(conn):
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+    
+    @contextmanager
+    def _acquire(self):
+        conn = self._read_pool.get()
+        try:
+            yield conn
+        finally:
+            self._read_pool.put(conn)
+    
+    def _invalidate_contact(self, contact_id):
+        """Drop a cached contact; call after any write that changes it"""
+        self._contact_cache.pop(contact_id, None)
+        self._contact_writes += 1
     
-    def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    @staticmethod
+    def _copy_contact(contact):
+        # Callers get their own copy so they cannot mutate the cached entry
+        if contact is None:
+            return None
+        return {**contact, 'tags': list(contact['tags'])}
+    
+    def close(self):
+        while not self._read_pool.empty():
+            self._read_pool.get_nowait().close()
+        self._rw_conn.close()
+    
+    @classmethod
+    def ensure_schema(cls, db_path):
+        """Create tables and indexes; run once before opening any SimpleCRM"""
+        conn = sqlite3.connect(db_path)
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.execute('PRAGMA journal_mode=WAL')
         
-        cursor.execute('''
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS contacts (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT,
@@ -37,7 +127,7 @@ class SimpleCRM:
             )
         ''')
         
-        cursor.execute('''
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS deals (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 contact_id INTEGER,
@@ -49,110 +139,210 @@ class SimpleCRM:
             )
         ''')
         
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_deals_contact ON deals(contact_id)')
+        
         conn.commit()
         conn.close()
     
-    def create_contact(self, name, email=None, phone=None, company=None, tags=None):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    async def create_contact(self, name, email=None, phone=None, company=None, tags=None):
+        async def write():
+            async with self._write_lock:
+                cursor = await asyncio.to_thread(
+                    self._rw_conn.execute,
+                    self._INSERT_CONTACT_SQL,
+                    (name, email, phone, company, orjson.dumps(tags or []).decode())
+                )
+            contact_id = cursor.lastrowid
+            
+            # A lookup of this id before it existed may have cached None
+            self._invalidate_contact(contact_id)
+            
+            return contact_id
         
-        cursor.execute(
-            '''INSERT INTO contacts (name, email, phone, company, tags)
-               VALUES (?, ?, ?, ?, ?)''',
-            (name, email, phone, company, json.dumps(tags or []))
-        )
+        # Shielded so a cancelled call cannot release the lock mid-write
+        return await asyncio.shield(write())
+    
+    def _fetch_contact_row(self, contact_id):
+        with self._acquire() as conn:
+            return conn.execute(
+                '''SELECT id, name, email, phone, company, json(tags) AS tags
+                   FROM contacts WHERE id = ?''',
+                (contact_id,)
+            ).fetchone()
+    
+    async def get_contact(self, contact_id):
+        cached = self._contact_cache.get(contact_id)
+        if cached and time.monotonic() - cached[0] < CONTACT_CACHE_TTL:
+            self._contact_cache.move_to_end(contact_id)
+            return self._copy_contact(cached[1])
         
-        contact_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        writes_before = self._contact_writes
+        row = await asyncio.to_thread(self._fetch_contact_row, contact_id)
         
-        return contact_id
-    
-    def get_contact(self, contact_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        contact = None
+        if row:
+            contact = dict(row)
+            contact['tags'] = orjson.loads(row['tags']) if row['tags'] else []
         
-        cursor.execute('SELECT * FROM contacts WHERE id = ?', (contact_id,))
-        row = cursor.fetchone()
+        # A write during the fetch may have made this row stale; don't cache it
+        if self._contact_writes == writes_before:
+            self._contact_cache[contact_id] = (time.monotonic(), contact)
+            self._contact_cache.move_to_end(contact_id)
+            if len(self._contact_cache) > CONTACT_CACHE_SIZE:
+                self._contact_cache.popitem(last=False)
         
-        conn.close()
+        return self._copy_contact(contact)
+    
+    async def create_deal(self, contact_id, title, value, stage='new'):
+        async def write():
+            async with self._write_lock:
+                cursor = await asyncio.to_thread(
+                    self._rw_conn.execute,
+                    self._INSERT_DEAL_SQL,
+                    (contact_id, title, value, stage)
+                )
+            
+            self._invalidate_contact(contact_id)
+            
+            return cursor.lastrowid
         
-        if row:
-            return {
-                'id': row[0],
-                'name': row[1],
-                'email': row[2],
-                'phone': row[3],
-                'company': row[4],
-                'tags': json.loads(row[5] or '[]')
-            }
-        return None
+        # Shielded so a cancelled call cannot release the lock mid-write
+        return await asyncio.shield(write())
     
-    def create_deal(self, contact_id, title, value, stage='new'):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    async def bulk_create(self, contacts=(), deals=()):
+        """Create many contacts and deals in a single transaction"""
+        contact_rows = [
+            (c['name'], c.get('email'), c.get('phone'), c.get('company'),
+             orjson.dumps(c.get('tags') or []).decode())
+            for c in contacts
+        ]
+        deal_rows = [
+            (d['contact_id'], d['title'], d['value'], d.get('stage', 'new'))
+            for d in deals
+        ]
         
-        cursor.execute(
-            '''INSERT INTO deals (contact_id, title, value, stage)
-               VALUES (?, ?, ?, ?)''',
-            (contact_id, title, value, stage)
-        )
+        async def write():
+            async with self._write_lock:
+                contact_ids = await asyncio.to_thread(self._insert_many, contact_rows, deal_rows)
+            
+            for contact_id in contact_ids:
+                self._invalidate_contact(contact_id)
+            for row in deal_rows:
+                self._invalidate_contact(row[0])
+            
+            return contact_ids
         
-        deal_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        # Shielded so a cancelled call cannot release the lock while the
+        # transaction is still open on the shared connection
+        return await asyncio.shield(write())
+    
+    def _insert_many(self, contact_rows, deal_rows):
+        self._rw_conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Contacts are inserted one by one so each new id can be returned
+            contact_ids = [
+                self._rw_conn.execute(self._INSERT_CONTACT_SQL, row).lastrowid
+                for row in contact_rows
+            ]
+            self._rw_conn.executemany(self._INSERT_DEAL_SQL, deal_rows)
+            self._rw_conn.execute('COMMIT')
+        except Exception:
+            if self._rw_conn.in_transaction:
+                self._rw_conn.execute('ROLLBACK')
+            raise
         
-        return deal_id
+        return contact_ids
 
 # Initialize MCP server
 server = Server("crm-integration")
-crm = SimpleCRM(os.path.join(os.path.dirname(__file__), '../../data/crm.db'))
+CRM_DB_PATH = os.path.join(os.path.dirname(__file__), '../../data/crm.db')
+SimpleCRM.ensure_schema(CRM_DB_PATH)
+crm = SimpleCRM(CRM_DB_PATH)
+
+# Tool definitions never change, so build them once at import
+TOOLS = [
+    types.Tool(
+        name="create_contact",
+        description="Create a new contact in the CRM",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "name": {"type": "string"},
+                "email": {"type": "string"},
+                "phone": {"type": "string"},
+                "company": {"type": "string"},
+                "tags": {"type": "array", "items": {"type": "string"}}
+            },
+            "required": ["name"]
+        }
+    ),
+    types.Tool(
+        name="get_contact",
+        description="Retrieve contact information",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "contact_id": {"type": "integer"}
+            },
+            "required": ["contact_id"]
+        }
+    ),
+    types.Tool(
+        name="create_deal",
+        description="Create a new deal for a contact",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "contact_id": {"type": "integer"},
+                "title": {"type": "string"},
+                "value": {"type": "number"},
+                "stage": {"type": "string"}
+            },
+            "required": ["contact_id", "title", "value"]
+        }
+    ),
+    types.Tool(
+        name="bulk_create",
+        description="Create several contacts and deals in one transaction",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "contacts": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string"},
+                            "email": {"type": "string"},
+                            "phone": {"type": "string"},
+                            "company": {"type": "string"},
+                            "tags": {"type": "array", "items": {"type": "string"}}
+                        },
+                        "required": ["name"]
+                    }
+                },
+                "deals": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "contact_id": {"type": "integer"},
+                            "title": {"type": "string"},
+                            "value": {"type": "number"},
+                            "stage": {"type": "string"}
+                        },
+                        "required": ["contact_id", "title", "value"]
+                    }
+                }
+            }
+        }
+    )
+]
 
 @server.list_tools()
 async def handle_list_tools() -> list[types.Tool]:
     """List available CRM tools"""
-    return [
-        types.Tool(
-            name="create_contact",
-            description="Create a new contact in the CRM",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "name": {"type": "string"},
-                    "email": {"type": "string"},
-                    "phone": {"type": "string"},
-                    "company": {"type": "string"},
-                    "tags": {"type": "array", "items": {"type": "string"}}
-                },
-                "required": ["name"]
-            }
-        ),
-        types.Tool(
-            name="get_contact",
-            description="Retrieve contact information",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "contact_id": {"type": "integer"}
-                },
-                "required": ["contact_id"]
-            }
-        ),
-        types.Tool(
-            name="create_deal",
-            description="Create a new deal for a contact",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "contact_id": {"type": "integer"},
-                    "title": {"type": "string"},
-                    "value": {"type": "number"},
-                    "stage": {"type": "string"}
-                },
-                "required": ["contact_id", "title", "value"]
-            }
-        )
-    ]
+    return TOOLS
 
 @server.call_tool()
 async def handle_call_tool(
@@ -161,7 +351,7 @@ async def handle_call_tool(
     """Handle tool execution"""
     
     if name == "create_contact":
-        contact_id = crm.create_contact(
+        contact_id = await crm.create_contact(
             name=arguments["name"],
             email=arguments.get("email"),
             phone=arguments.get("phone"),
@@ -170,18 +360,18 @@ async def handle_call_tool(
         )
         return [types.TextContent(
             type="text",
-            text=json.dumps({"contact_id": contact_id, "status": "created"})
+            text=orjson.dumps({"contact_id": contact_id, "status": "created"}).decode()
         )]
     
     elif name == "get_contact":
-        contact = crm.get_contact(arguments["contact_id"])
+        contact = await crm.get_contact(arguments["contact_id"])
         return [types.TextContent(
             type="text",
-            text=json.dumps(contact)
+            text=orjson.dumps(contact).decode()
         )]
     
     elif name == "create_deal":
-        deal_id = crm.create_deal(
+        deal_id = await crm.create_deal(
             contact_id=arguments["contact_id"],
             title=arguments["title"],
             value=arguments["value"],
@@ -189,26 +379,44 @@ async def handle_call_tool(
         )
         return [types.TextContent(
             type="text",
-            text=json.dumps({"deal_id": deal_id, "status": "created"})
+            text=orjson.dumps({"deal_id": deal_id, "status": "created"}).decode()
+        )]
+    
+    elif name == "bulk_create":
+        deals = arguments.get("deals", [])
+        contact_ids = await crm.bulk_create(
+            contacts=arguments.get("contacts", []),
+            deals=deals
+        )
+        return [types.TextContent(
+            type="text",
+            text=orjson.dumps({
+                "contact_ids": contact_ids,
+                "deals_created": len(deals),
+                "status": "created"
+            }).decode()
         )]
     
     raise ValueError(f"Unknown tool: {name}")
 
 async def main():
     """Run the MCP server"""
-    async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
-        await server.run(
-            read_stream,
-            write_stream,
-            InitializationOptions(
-                server_name="crm-integration",
-                server_version="1.0.0",
-                capabilities=server.get_capabilities(
-                    notification_options=NotificationOptions(),
-                    experimental_capabilities={}
+    try:
+        async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
+            await server.run(
+                read_stream,
+                write_stream,
+                InitializationOptions(
+                    server_name="crm-integration",
+                    server_version="1.0.0",
+                    capabilities=server.get_capabilities(
+                        notification_options=NotificationOptions(),
+                        experimental_capabilities={}
+                    )
                 )
             )
-        )
+    finally:
+        crm.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file